@@ -1,15 +1,26 @@
-from typing import Optional, Set, Tuple
+from contextlib import contextmanager
+from time import monotonic
+from typing import Iterator, Optional, Tuple
 
 from django.contrib import admin, messages
-from django.db.models import Count, F, Q
+from django.core.paginator import Paginator
+from django.db import OperationalError, connections, transaction
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.models import Exists, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.db.models.query import QuerySet
 from django.http import HttpRequest
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 from .models import (
 	Author,
 	ExclusionCriterion,
 	Publication,
+	PublicationAuthor,
+	PublicationReference,
+	PublicationSource,
+	PublicationTag,
 	SearchTerm,
 	SemanticScholar,
 	Source,
@@ -17,6 +28,73 @@ from .models import (
 )
 
 
+# Expressions
+
+
+class SubqueryCount(Subquery):
+	"""
+	Count the rows returned by a correlated subquery.
+
+	Unlike `Count`, this does not join the related tables into the outer query,
+	so counting the outer query, e. g., for pagination, does not evaluate the
+	annotation at all.
+	"""
+
+	template = "(SELECT COUNT(*) FROM (%(subquery)s) _count)"
+	output_field = IntegerField()
+
+
+# Paginators
+
+
+@contextmanager
+def statement_timeout(connection: BaseDatabaseWrapper, timeout: int) -> Iterator[None]:
+	"""
+	Abort statements that take longer than `timeout` milliseconds.
+
+	Must be used within a transaction. Aborted statements raise an
+	`OperationalError`.
+	"""
+
+	if connection.vendor == 'postgresql':
+		with connection.cursor() as cursor:
+			cursor.execute("SET LOCAL statement_timeout TO %s", [timeout])
+		yield
+	elif connection.vendor == 'sqlite':
+		deadline = monotonic() + timeout / 1000
+		connection.ensure_connection()
+		connection.connection.set_progress_handler(lambda: monotonic() > deadline, 10000)
+		try:
+			yield
+		finally:
+			connection.connection.set_progress_handler(None, 0)
+	else:
+		yield
+
+
+class TimeoutPaginator(Paginator):
+	"""
+	Paginator that gives up counting the results after a timeout.
+
+	Counting annotated querysets is slow for large tables, which makes the
+	change list slow to load. If counting takes too long, a large number is
+	returned instead of the actual count.
+	"""
+
+	timeout = 200  # ms
+	fallback_count = 9999999
+
+	@cached_property
+	def count(self) -> int:
+		using = getattr(self.object_list, 'db', 'default')
+		try:
+			with transaction.atomic(using=using):
+				with statement_timeout(connections[using], self.timeout):
+					return super().count
+		except OperationalError:
+			return self.fallback_count
+
+
 # Filters
 
 
@@ -52,7 +130,10 @@ class PublicationRelevanceFilter(admin.SimpleListFilter):
 		if self.value() == 'yes':
 			return queryset.filter(exclusion_criteria__isnull=True)
 		if self.value() == 'no':
-			return queryset.filter(exclusion_criteria__isnull=False)
+			# Does not join, which would list publications once per criterion
+			return queryset.filter(Exists(
+				Publication.exclusion_criteria.through.objects.filter(publication=OuterRef('pk')),
+			))
 		return queryset
 
 
@@ -70,39 +151,11 @@ class PublicationStageFilter(admin.SimpleListFilter):
 		)
 
 	def queryset(self, request: HttpRequest, queryset: QuerySet) -> QuerySet:
-		if self.value() == 'excluded':
-			return queryset.filter(exclusion_criteria__isnull=False)
-
-		relevant = queryset.filter(exclusion_criteria__isnull=True)
-
-		if self.value() == 'primary':
-			return relevant.filter(sources__isnull=False)
-
-		if self.value() == 'secondary':
-			return relevant.filter(
-				referenced_by__exclusion_criteria__isnull=True,
-				referenced_by__sources__isnull=False,
-				sources__isnull=True,
-			)
-
-		if self.value() == 'tertiary':
-			return relevant.filter(
-				references__exclusion_criteria__isnull=True,
-				references__sources__isnull=False,
-				sources__isnull=True,
-			).exclude(
-				referenced_by__exclusion_criteria__isnull=True,
-				referenced_by__sources__isnull=False,
-			)
-
+		# Uses the stage annotated by `PublicationAdmin.get_queryset`
 		if self.value() == '-':
-			ids: Set[int] = {
-				publication.id
-				for publication in queryset
-				if publication.stage is None
-			}
-			return queryset.filter(id__in=ids)
-
+			return queryset.filter(stage_value__isnull=True)
+		if value := self.value():
+			return queryset.filter(stage_value=value)
 		return queryset
 
 
@@ -112,16 +165,15 @@ class TagCategoryFilter(admin.SimpleListFilter):
 
 	def lookups(self, request: HttpRequest, model_admin) -> Tuple[Tuple[str, str], ...]:
 		return (
-			(str(tag.pk), tag.name)
-			for tag in Tag.objects.filter(implies__isnull=True)
+			(str(pk), name)
+			for pk, name in Tag.objects.filter(implies__isnull=True).values_list('pk', 'name')
 		)
 
 	def queryset(self, request: HttpRequest, queryset: QuerySet) -> QuerySet:
 		if value := self.value():
 			pk = int(value)
-			category = Tag.objects.get(pk=pk)
 			# TODO Make transitive?
-			return queryset.filter(implies=category)
+			return queryset.filter(implies=pk)
 		return queryset
 
 
@@ -192,14 +244,17 @@ class AuthorAdmin(admin.ModelAdmin):
 	list_display = ('name', 'publication_count', 'relevant_publication_count')
 	search_fields = ('name',)
 	inlines = (AuthorPublicationsInline,)
+	paginator = TimeoutPaginator
+	show_full_result_count = False
 
 	def get_queryset(self, request: HttpRequest) -> QuerySet:
+		publications = PublicationAuthor.objects.filter(author=OuterRef('pk'))
 		return Author.objects.annotate(
-			publication_count=Count('publications', distinct=True),
-			relevant_publication_count=Count(
-				'publications',
-				filter=Q(publications__exclusion_criteria__isnull=True),
-				distinct=True,
+			publication_count=SubqueryCount(publications.values('publication')),
+			relevant_publication_count=SubqueryCount(
+				publications.filter(
+					publication__exclusion_criteria__isnull=True,
+				).values('publication'),
 			),
 		)
 
@@ -222,7 +277,13 @@ class ExclusionCriteriaAdmin(admin.ModelAdmin):
 	inlines = (ExclusionCriterionPublications,)
 
 	def get_queryset(self, request: HttpRequest) -> QuerySet:
-		return ExclusionCriterion.objects.annotate(publication_count=Count('publications'))
+		return ExclusionCriterion.objects.annotate(
+			publication_count=SubqueryCount(
+				ExclusionCriterion.publications.through.objects.filter(
+					exclusioncriterion=OuterRef('pk'),
+				).values('publication'),
+			),
+		)
 
 	def publication_count(self, obj: ExclusionCriterion) -> int:
 		return obj.publication_count
@@ -238,9 +299,15 @@ class TagAdmin(admin.ModelAdmin):
 	search_fields = ('name',)
 	autocomplete_fields = ('implies',)
 	inlines = (TagPublicationsInline,)
+	paginator = TimeoutPaginator
+	show_full_result_count = False
 
 	def get_queryset(self, request: HttpRequest) -> QuerySet:
-		return Tag.objects.annotate(publication_count=Count('publications'))
+		return Tag.objects.annotate(
+			publication_count=SubqueryCount(
+				PublicationTag.objects.filter(tag=OuterRef('pk')).values('publication'),
+			),
+		)
 
 	#def _implied_by(self, obj: Tag) -> str:
 	#	return ", ".join(map(str, obj.implied_by.order_by('name')))
@@ -266,10 +333,11 @@ class SearchTermAdmin(admin.ModelAdmin):
 
 	def get_queryset(self, request: HttpRequest) -> QuerySet:
 		return SearchTerm.objects.annotate(
-			publication_count=Count(
-				'publicationsource__publication',
-				filter=Q(publicationsource__publication__exclusion_criteria__isnull=True),
-				distinct=True,
+			publication_count=SubqueryCount(
+				PublicationSource.objects.filter(
+					search_term=OuterRef('pk'),
+					publication__exclusion_criteria__isnull=True,
+				).values('publication').distinct(),
 			),
 		)
 
@@ -287,7 +355,11 @@ class SourceAdmin(admin.ModelAdmin):
 
 	def get_queryset(self, request: HttpRequest) -> QuerySet:
 		return Source.objects.annotate(
-			publication_count=Count('publications', distinct=True),
+			publication_count=SubqueryCount(
+				PublicationSource.objects.filter(
+					source=OuterRef('pk'),
+				).values('publication').distinct(),
+			),
 		)
 
 	def publication_count(self, obj: Source) -> int:
@@ -328,20 +400,24 @@ class PublicationAdmin(admin.ModelAdmin):
 	)
 	autocomplete_fields = ('exclusion_criteria', 'variant_of')
 	actions = ('cite',)
+	paginator = TimeoutPaginator
+	show_full_result_count = False
 
 	def get_queryset(self, request: HttpRequest) -> QuerySet:
-		return Publication.objects.annotate(
-			citation_count=Count(
-				'referenced_by',
-				filter=Q(exclusion_criteria__isnull=True),
-				distinct=True,
+		return Publication.objects.with_stage().annotate(
+			citation_count=SubqueryCount(
+				PublicationReference.objects.filter(
+					reference=OuterRef('pk'),
+					publication__exclusion_criteria__isnull=True,
+				).values('publication'),
 			),
-			references_count=Count(
-				'references',
-				filter=Q(exclusion_criteria__isnull=True),
-				distinct=True,
+			references_count=SubqueryCount(
+				PublicationReference.objects.filter(
+					publication=OuterRef('pk'),
+					reference__exclusion_criteria__isnull=True,
+				).values('reference'),
 			),
-			page_count=1 + F('last_page') - F('first_page'),
+			page_count=Coalesce(F('last_page') - F('first_page') + 1, 0),
 		)
 
 	def citation_count(self, obj: Publication) -> int:
@@ -353,6 +429,9 @@ class PublicationAdmin(admin.ModelAdmin):
 	def page_count(self, obj: Publication) -> int:
 		return obj.page_count
 
+	def stage(self, obj: Publication) -> Optional[str]:
+		return obj.stage_value
+
 	def cite(self, request: HttpRequest, queryset: QuerySet):
 		cite_keys = queryset.order_by('cite_key').values_list('cite_key', flat=True).distinct()
 		cite_str = ", ".join(list(cite_keys))
@@ -364,3 +443,4 @@ class PublicationAdmin(admin.ModelAdmin):
 	references_count.admin_order_field = 'references_count'
 	page_count.short_description = "pages"
 	page_count.admin_order_field = 'page_count'
+	stage.admin_order_field = 'stage_value'
@@ -0,0 +1,74 @@
+import pickle
+import sqlite3
+
+from pathlib import Path
+from typing import Dict, Iterable, Set, Tuple, Union
+
+
+class Choices:
+	"""
+	Entries previously rejected by the user, shared between commands.
+
+	Choices are stored per `source` and per `query`, e.g., a search term.
+	Choices of earlier versions, stored in `.choices.<source>.pickle`, are
+	imported on first use.
+	"""
+
+	def __init__(self, source: str, path: Path = Path('.choices.sqlite')):
+		self.source = source
+		self.connection = sqlite3.connect(path)
+		self.connection.execute("""
+			CREATE TABLE IF NOT EXISTS choice (
+				source TEXT NOT NULL,
+				query TEXT NOT NULL,
+				key TEXT NOT NULL,
+				PRIMARY KEY (source, query, key)
+			) WITHOUT ROWID
+		""")
+		self.import_legacy(path.parent / f'.choices.{source}.pickle')
+
+	def import_legacy(self, legacy_path: Path) -> None:
+		if not legacy_path.exists():
+			return
+
+		# Either keys per query (dblp) or a flat set of keys (semanticscholar)
+		with legacy_path.open('rb') as f:
+			legacy: Union[Dict[str, Set[str]], Set[str]] = pickle.load(f)
+		if isinstance(legacy, dict):
+			rows: Iterable[Tuple[str, str, str]] = (
+				(self.source, query, key)
+				for query, keys in legacy.items()
+				for key in keys
+			)
+		else:
+			rows = ((self.source, '', key) for key in legacy)
+
+		with self.connection:
+			self.connection.executemany("INSERT OR IGNORE INTO choice VALUES (?, ?, ?)", rows)
+
+		# Keep the file, but do not import it again
+		legacy_path.rename(legacy_path.with_name(legacy_path.name + '.imported'))
+
+	def __enter__(self) -> 'Choices':
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.connection.close()
+
+	def reset(self) -> None:
+		with self.connection:
+			self.connection.execute("DELETE FROM choice WHERE source = ?", (self.source,))
+
+	def load(self, query: str = '') -> Set[str]:
+		rows = self.connection.execute(
+			"SELECT key FROM choice WHERE source = ? AND query = ?",
+			(self.source, query),
+		)
+		return {key for key, in rows}
+
+	def add(self, key: str, query: str = '') -> None:
+		with self.connection:  # Commit each choice
+			self.connection.execute(
+				"INSERT OR IGNORE INTO choice VALUES (?, ?, ?)",
+				(self.source, query, key),
+			)
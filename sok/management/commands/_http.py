@@ -0,0 +1,22 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Maximum number of concurrent requests per host
+MAX_CONNECTIONS = 16
+
+# Reuse connections to the DBLP and Semantic Scholar APIs across commands
+session = requests.Session()
+adapter = HTTPAdapter(
+	pool_connections=4,
+	pool_maxsize=MAX_CONNECTIONS,
+	max_retries=Retry(
+		total=3,
+		backoff_factor=0.5,
+		status_forcelist=(429, 500, 502, 503, 504),
+	),
+)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
@@ -1,7 +1,7 @@
 from typing import Set, Tuple
 
 from django.core.management.base import BaseCommand, CommandParser
-from django.db.models import Count, Q
+from django.db.models import Count, Prefetch, Q
 
 from sok.models import Publication, PublicationReference
 
@@ -25,20 +25,35 @@ class Command(BaseCommand):
 				distinct=True,
 			),
 		).filter(citation_count__gte=min_citations)
+		pks: Set[int] = set(publications.values_list('pk', flat=True))
 
 		self.echo("digraph G {")
 		self.echo("\trankdir = BT;")
 
 		graph: Set[Tuple[int, int]] = set()
 
-		for publication in publications:
-
-			if publication.stage != 'primary':
-				continue
-
-			for reference in publication.relevant_references:
-
-				if reference not in publications:
+		rels = PublicationReference.objects.filter(
+			publication__in=pks,
+			reference__in=pks,
+		).prefetch_related('publication__authors', 'reference__authors')
+		self_cites: Set[Tuple[int, int]] = {
+			(rel.publication_id, rel.reference_id)
+			for rel in rels
+			if rel.is_self_cite
+		}
+
+		publications = publications.only('pk', 'cite_key').with_stage().filter(
+			stage_value='primary',
+		).prefetch_related(
+			Prefetch('references', queryset=Publication.objects.only('pk', 'cite_key')),
+		)
+		for publication in publications.iterator(chunk_size=2000):
+
+			# Irrelevant references are not in `pks`, so the prefetched
+			# references can be used instead of `relevant_references`.
+			for reference in publication.references.all():
+
+				if reference.pk not in pks:
 					continue
 
 				graph.add((publication.pk, reference.pk))
@@ -52,9 +67,7 @@ class Command(BaseCommand):
 				else:
 					self.echo(f'\t"{publication.cite_key}" -> "{reference.cite_key}"', nl=False)
 
-				rel = PublicationReference.objects.get(publication=publication, reference=reference)
-
-				if rel.is_self_cite:
+				if (publication.pk, reference.pk) in self_cites:
 					self.echo(" [style=dashed]", nl=False)
 
 				self.echo(";")
@@ -1,6 +1,6 @@
-from typing import List
+from typing import Dict, List
 
-from django.core.management.base import BaseCommand, CommandParser
+from django.core.management.base import BaseCommand, CommandError, CommandParser
 
 from sok.models import Publication
 
@@ -12,6 +12,10 @@ class Command(BaseCommand):
 
 	def handle(self, *args, **options):
 		pks: List[int] = options['pk']
-		publications = [Publication.objects.get(pk=pk) for pk in pks]
-		cite_keys = [publication.cite_key for publication in publications]
+		cite_keys_by_pk: Dict[int, str] = dict(
+			Publication.objects.filter(pk__in=pks).values_list('pk', 'cite_key')
+		)
+		if missing := set(pks) - cite_keys_by_pk.keys():
+			raise CommandError(f"Unknown publication(s): {', '.join(map(str, sorted(missing)))}")
+		cite_keys = [cite_keys_by_pk[pk] for pk in pks]
 		self.stdout.write(r"\cite{" + ",".join(cite_keys) + "}", ending='')
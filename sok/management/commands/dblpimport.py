@@ -1,20 +1,20 @@
 import html
-import io
-import pickle
-import string
-import xml.sax
+import re
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
+from functools import cached_property
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Tuple, Union
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
-import requests
+from lxml import etree
 
 from django.db import transaction
 from django.core.management.base import BaseCommand, CommandParser, CommandError
 
+from sok.management.commands._http import session
 from sok.models import (
 	Author,
 	Publication,
@@ -25,9 +25,6 @@ from sok.models import (
 )
 
 
-Attributes = xml.sax.xmlreader.AttributesImpl
-
-
 PUBLICATIONS = {
 	'article',
 	'inproceedings',
@@ -44,6 +41,8 @@ PUBLICATIONS = {
 CITE_KEY_PREFIX = 'DBLP:'
 DUMP_PATH = Path('dblp') / 'dblp-2021-03-01.xml'
 
+MAX_API_REQUESTS = 8
+
 
 def strip_cite_key_prefix(value: str) -> str:
 	if value.startswith(CITE_KEY_PREFIX):
@@ -51,8 +50,11 @@ def strip_cite_key_prefix(value: str) -> str:
 	return value
 
 
+NON_DIGITS = re.compile(r'[^0-9]')
+
+
 def strip_issue_from_page(value: str) -> int:
-	return int(''.join(c for c in value.split(':')[-1] if c in string.digits))
+	return int(NON_DIGITS.sub('', value.rpartition(':')[2]))
 
 
 def clean_title(value: str) -> str:
@@ -85,8 +87,51 @@ def parse_pages(raw: str) -> Tuple[int, int]:
 	raise NotImplementedError(f"Unexpected value for <pages>: {raw}")
 
 
-class FinishedParsing(Exception):
-	pass
+def get_text(element: etree._Element) -> str:
+	"""
+	Get the text of an element, including the text of its descendants.
+
+	The entities declared by the DBLP DTD are the named HTML entities. They are
+	expanded here, so that the DTD does not need to be loaded and its entities
+	do not need to be resolved by the parser.
+	"""
+
+	parts: List[str] = []
+	if element.text is not None:
+		parts.append(element.text)
+	for child in element:
+		if isinstance(child, etree._Entity):
+			parts.append(html.unescape(child.text))
+		else:
+			parts.append(get_text(child))
+		if child.tail is not None:
+			parts.append(child.tail)
+	return ''.join(parts)
+
+
+def iter_publication_elements(path: Path) -> Iterator[etree._Element]:
+	"""
+	Iterate over the publication elements of a DBLP dump.
+
+	Only publication elements are passed to Python, all other elements are
+	filtered by the parser. Elements are cleared after they were handled in
+	order to keep memory usage bounded, so they must not be used after
+	advancing the iterator.
+	"""
+
+	elements = etree.iterparse(
+		str(path),
+		events=('end',),
+		tag=PUBLICATIONS,
+		resolve_entities=False,  # See `get_text`
+		huge_tree=True,
+	)
+	for _, element in elements:
+		yield element
+
+		element.clear()
+		while element.getprevious() is not None:
+			del element.getparent()[0]
 
 
 @dataclass(frozen=True)
@@ -102,7 +147,7 @@ class PublicationResult:
 	def cite_key(self) -> str:
 		return CITE_KEY_PREFIX + self.key
 
-	@property
+	@cached_property  # Works with frozen dataclasses, as it bypasses `__setattr__`
 	def doi(self) -> Optional[str]:
 		for url_str in self.urls:
 			url = urlparse(url_str)
@@ -143,40 +188,57 @@ class PublicationResult:
 			return None
 		return self.pages[1]
 
+	@classmethod
+	def from_element(cls, element: etree._Element) -> 'PublicationResult':
+		authors = [get_text(author) for author in element.iterfind('author')]
+		assert 0 < len(authors)
+
+		pages: Optional[Tuple[int, int]] = None
+		if raw_pages := element.findtext('pages'):
+			pages = parse_pages(raw_pages)
+
+		return cls(
+			key=element.get('key'),
+			title=clean_title(get_text(element.find('title'))),
+			year=int(element.findtext('year')),
+			pages=pages,
+			authors=authors,
+			urls=[get_text(url) for url in element.iterfind('ee')],
+		)
+
 	@classmethod
 	def from_dump(cls, path: Path, keys: Set[str]) -> List['PublicationResult']:
-		parser = xml.sax.make_parser()
+		remaining = set(keys)
+		publications: List[PublicationResult] = []
+		if 0 == len(remaining):
+			return publications
 
-		# Enable DTD parsing
-		parser.setFeature(xml.sax.handler.feature_external_ges, True)
+		for element in iter_publication_elements(path):
+			key = element.get('key')
+			if key not in remaining:
+				continue  # This is not the publication you are looking for.
 
-		handler = DBLPHandler(keys)
-		parser.setContentHandler(handler)
-		try:
-			parser.parse(path)
-		except FinishedParsing:
-			pass  # Just a workaround to abort SAX parsing if all entries were found
+			remaining.remove(key)
+			publications.append(cls.from_element(element))
 
-		return handler.publications
+			if 0 == len(remaining):
+				break
+
+		return publications
 
 	@classmethod
 	def from_api(cls, key: str) -> 'PublicationResult':
 
 		url = f"https://dblp.uni-trier.de/rec/{key}.xml"
-		response = requests.get(url)
-		response.raise_for_status
+		response = session.get(url)
+		response.raise_for_status()
 
-		parser = xml.sax.make_parser()
-		handler = DBLPHandler({key})
-		parser.setContentHandler(handler)
-		try:
-			parser.parse(io.BytesIO(response.content))
-		except FinishedParsing:
-			pass
+		root = etree.fromstring(response.content)
+		elements = [element for element in root if element.get('key') == key]
 
-		assert 1 == len(handler.publications)
+		assert 1 == len(elements)
 
-		return handler.publications[0]
+		return cls.from_element(elements[0])
 
 	@classmethod
 	def from_search_hit(cls, hit: Dict[str, Any]) -> 'PublicationResult':
@@ -208,8 +270,8 @@ class PublicationResult:
 		limit: int = 1000,
 	) -> Tuple[str, List['PublicationResult'], int]:
 		# see https://dblp.uni-trier.de/faq/13501473.html
-		url = 'http://dblp.org/search/publ/api'
-		response = requests.get(
+		url = 'https://dblp.org/search/publ/api'
+		response = session.get(
 			url,
 			params={
 				'q': search_term,
@@ -219,7 +281,7 @@ class PublicationResult:
 				'format': 'json',
 			},
 		)
-		response.raise_for_status
+		response.raise_for_status()
 		search_result = response.json()['result']
 		hits = search_result['hits']
 		results = [cls.from_search_hit(hit) for hit in hits['hit']]
@@ -230,161 +292,26 @@ class PublicationResult:
 		return (search_result['query'], results, total)
 
 
-@dataclass
-class DBLPFullHandler(xml.sax.handler.ContentHandler):
-	entries: Dict[str, str] = field(default_factory=dict)
-
-	# ContentHandler
-
-	def startElement(self, name: str, attributes: Attributes):
-		if name in PUBLICATIONS:
-			key = attributes.getValue('key')
-			self.entries[key] = name
-
-
-def get_all_cite_keys(path: Path) -> Set[str]:
-	cache_path = path.with_suffix('.pickle')
-	cache: Dict[str, str] = dict()
+def iter_all_cite_keys(path: Path) -> Iterator[str]:
+	# Cache the keys as plain text, one key per line
+	cache_path = path.with_suffix('.keys.txt')
 	if cache_path.exists():
-		with cache_path.open('rb') as f:
-			cache = pickle.load(f)
-	else:
-		parser = xml.sax.make_parser()
-
-		# Enable DTD parsing
-		parser.setFeature(xml.sax.handler.feature_external_ges, True)
-
-		handler = DBLPFullHandler()
-		parser.setContentHandler(handler)
-		parser.parse(path)
-
-		cache = handler.entries
-		with cache_path.open('wb') as f:
-			pickle.dump(cache, f)
-
-	return {CITE_KEY_PREFIX + key for key in cache.keys()}
-
-
-@dataclass
-class DBLPHandler(xml.sax.handler.ContentHandler):
-	key_queue: Set[str]
-	tag_stack: List[str] = field(default_factory=list)
-	publications: List[PublicationResult] = field(default_factory=list)
-	key: Optional[str] = None
-	author: Optional[str] = None
-	authors: List[Author] = field(default_factory=list)
-	title: Optional[str] = None
-	year: Optional[int] = None
-	pages: Optional[Tuple[int, int]] = None
-	urls: List[str] = field(default_factory=list)
-
-	@property
-	def current_tag(self) -> str:
-		assert 0 < len(self.tag_stack)
-		return self.tag_stack[-1]
-
-	@property
-	def is_handling_publication(self) -> bool:
-		return self.key is not None
-
-	def startElement(self, name: str, attributes: Attributes):
-		self.tag_stack.append(name)
-
-		if name in PUBLICATIONS:
-			self.startPublication(name, attributes)
-
-		if not self.is_handling_publication:
-			return
-
-		if name == 'author':
-			self.author = ''
-		if name == 'title':
-			self.title = ''
-
-	def endElement(self, name: str):
-		self.tag_stack.pop(-1)
-
-		if self.is_handling_publication and name in PUBLICATIONS:
-			self.endPublication()
-
-		if name == 'author' and self.author is not None:
-			self.authors.append(self.author)
-			self.author = None
-
-	def characters(self, content: Union[bytes, str]):
-		assert isinstance(content, str)  # TODO Handle bytes?
-
-		if not self.is_handling_publication:
-			return
-
-		if 'author' in self.tag_stack:
-			assert self.author is not None
-			self.author += content
-
-		if 'title' in self.tag_stack:
-			assert self.title is not None
-			self.title += content
-
-		if self.current_tag == 'ee':
-			self.urls.append(content)
-
-		if self.current_tag == 'year':
-			assert self.year is None
-			self.year = int(content)
-
-		if self.current_tag == 'pages':
-			assert self.pages is None
-			self.pages = parse_pages(content)
-
-	def startPublication(self, name: str, attributes: Attributes):
-		assert name in PUBLICATIONS
-		assert not self.is_handling_publication
-		assert 'key' in attributes
-		assert self.author is None
-		assert 0 == len(self.authors)
-		assert self.title is None
-		assert self.year is None
-		assert self.pages is None
-		assert 0 == len(self.urls)
-
-		key = attributes.getValue('key')
-		if key not in self.key_queue:
-			return  # This is not the publication you are looking for.
-
-		self.key_queue.remove(key)
-		self.key = key
-
-	def endPublication(self):
-		assert self.is_handling_publication
-		assert self.author is None
-		assert self.key is not None
-		assert self.title is not None
-		assert self.year is not None
-		assert 0 < len(self.authors)
-
-		title = self.title
-		if title.endswith('.'):
-			title = title[:-1]
-
-		publication = PublicationResult(
-			key=self.key,
-			title=title,
-			year=self.year,
-			authors=self.authors,
-			pages=self.pages,
-			urls=self.urls,
-		)
-		self.publications.append(publication)
-
-		self.key = None
-		self.authors = []
-		self.title = None
-		self.year = None
-		self.pages = None
-		self.urls = []
-
-		if 0 == len(self.key_queue):
-			raise FinishedParsing
+		with cache_path.open(encoding='utf-8') as f:
+			for line in f:
+				yield CITE_KEY_PREFIX + line.rstrip('\n')
+		return
+
+	# Only complete scans are cached
+	partial_path = path.with_suffix('.keys.partial')
+	try:
+		with partial_path.open('w', encoding='utf-8') as f:
+			for element in iter_publication_elements(path):
+				key = element.get('key')
+				f.write(key + '\n')
+				yield CITE_KEY_PREFIX + key
+		partial_path.replace(cache_path)
+	finally:
+		partial_path.unlink(missing_ok=True)
 
 
 class Command(BaseCommand):
@@ -394,7 +321,8 @@ class Command(BaseCommand):
 
 	def log_info(self, msg: str, nl: bool = True):
 		self.stdout.write(self.style.HTTP_INFO(msg), ending='\n' if nl else '')
-		self.stdout.flush()
+		if not nl:
+			self.stdout.flush()
 
 	# BaseCommand
 
@@ -406,6 +334,12 @@ class Command(BaseCommand):
 	@transaction.atomic
 	def handle(self, *args, **options):
 		use_api = options['use_api']
+		verbose: bool = 1 < options['verbosity']
+
+		# Bind the styled writers for the verbose loops once; not in __init__,
+		# as execute() replaces the style and output streams for some options
+		write = self.stdout.write
+		info, success = self.style.HTTP_INFO, self.style.SUCCESS
 		source = Source.objects.get(name='DBLP')
 
 		search_term: Optional[SearchTerm] = None
@@ -433,65 +367,116 @@ class Command(BaseCommand):
 				self.log_info(f"Parsing DBLP dump '{DUMP_PATH}'... ", nl=False)
 			start = datetime.now()
 			if use_api:
-				results: List[PublicationResult] = []
-				for key in cite_keys:
-					result = PublicationResult.from_api(key)
-					results.append(result)
+				with ThreadPoolExecutor(max_workers=MAX_API_REQUESTS) as executor:
+					results: List[PublicationResult] = list(executor.map(PublicationResult.from_api, cite_keys))
 			else:
 				results = PublicationResult.from_dump(DUMP_PATH, cite_keys)
 			end = datetime.now()
 			duration = end - start
 			self.log_success(f"done ({duration}).")
 
-			for result in results:
+			# Add authors to database
+			names: Set[str] = {name for result in results for name in result.authors}
+			authors_by_name: Dict[str, Author] = Author.objects.in_bulk(names, field_name='name')
+			new_names: Set[str] = names - authors_by_name.keys()
+			if 0 < len(new_names):
+				Author.objects.bulk_create(
+					[Author(name=name) for name in new_names],
+					ignore_conflicts=True,
+				)
+				# Only the new authors need to be re-read for their primary keys
+				authors_by_name.update(Author.objects.in_bulk(new_names, field_name='name'))
+			if verbose:
+				for name in sorted(names):
+					author = authors_by_name[name]
+					if name not in new_names:
+						write(info(f"Author '{author}' alreay known"))
+					else:
+						write(success(f"Added author: {author}"))
+			self.log_success(f"Added {len(new_names)} author(s), {len(names) - len(new_names)} already known")
+
+			# Add publications to database
+			keys: Set[str] = {result.cite_key for result in results}
+			known_publications: Dict[str, Publication] = Publication.objects.in_bulk(keys, field_name='cite_key')
+			Publication.objects.bulk_create(
+				[
+					Publication(
+						cite_key=result.cite_key,
+						title=result.title,
+						year=result.year,
+						peer_reviewed=result.is_peer_reviewed,
+						first_page=result.first_page,
+						last_page=result.last_page,
+						doi=result.doi,
+					)
+					for result in results
+					if result.cite_key not in known_publications
+				],
+			)
+			publications_by_key: Dict[str, Publication] = Publication.objects.in_bulk(keys, field_name='cite_key')
 
-				# Add authors to database
-				authors: List[Author] = []
-				for name in result.authors:
-					author, created = Author.objects.get_or_create(name=name)
-					if created:
-						self.log_success(f"Added author: {author}")
+			publication_authors: List[PublicationAuthor] = []
+			for result in results:
+				publication = publications_by_key[result.cite_key]
+				if verbose:
+					if result.cite_key in known_publications:
+						write(info(f"Publication '{publication}' already known"))
 					else:
-						self.log_info(f"Author '{author}' alreay known")
-					authors.append(author)
-
-				# Add publication to database
-				publication, created = Publication.objects.get_or_create(
-					cite_key=result.cite_key,
-					title=result.title,
-					year=result.year,
-					peer_reviewed=result.is_peer_reviewed,
-					first_page=result.first_page,
-					last_page=result.last_page,
-					doi=result.doi,
-				)
-				if created:
-					self.log_success(f"Added publication: {publication}")
-				else:
-					self.log_info(f"Publication '{publication}' already known")
+						write(success(f"Added publication: {publication}"))
 				publications.append(publication)
 
-				# Assign authors
-				for position, author in enumerate(authors):
-					publication_author, created = PublicationAuthor.objects.get_or_create(
-						author=author,
+				publication_authors += [
+					PublicationAuthor(
+						author=authors_by_name[name],
 						publication=publication,
 						position=position,
 					)
-					if created:
-						self.log_success(f"Assigned author '{author}' to publication '{publication}' at position {position}")
-					else:
-						self.log_info(f"Author '{author}' already assigned to publication '{publication}' at position '{position}'")
+					for position, name in enumerate(result.authors)
+				]
+
+			num_known = len(known_publications)
+			self.log_success(f"Added {len(keys) - num_known} publication(s), {num_known} already known")
+
+			# Assign authors
+			assigned: Set[Tuple[int, int, int]] = set(
+				PublicationAuthor.objects.filter(
+					publication__in=publications_by_key.values(),
+				).values_list('publication_id', 'author_id', 'position')
+			)
+			# Conflicting assignments, e.g., another author order, raise an error
+			PublicationAuthor.objects.bulk_create(
+				[
+					rel for rel in publication_authors
+					if (rel.publication.pk, rel.author.pk, rel.position) not in assigned
+				],
+				batch_size=1000,
+			)
+			num_known = 0
+			for rel in publication_authors:
+				author, publication, position = rel.author, rel.publication, rel.position
+				if (publication.pk, author.pk, position) in assigned:
+					num_known += 1
+					if verbose:
+						write(info(f"Author '{author}' already assigned to publication '{publication}' at position '{position}'"))
+				elif verbose:
+					write(success(f"Assigned author '{author}' to publication '{publication}' at position {position}"))
+			self.log_success(f"Assigned {len(publication_authors) - num_known} author(s), {num_known} already assigned")
 
 		# Assign sources
 		if search_term is not None:
+			num_known = 0
 			for publication in publications:
 				publication_source, created = PublicationSource.objects.get_or_create(
 					source=source,
 					publication=publication,
 					search_term=search_term,
 				)
+				if not created:
+					num_known += 1
+				if not verbose:
+					continue
 				if created:
-					self.log_success(f"Assigned source '{source}' to publication '{publication}' with search term '{search_term}'")
+					write(success(f"Assigned source '{source}' to publication '{publication}' with search term '{search_term}'"))
 				else:
-					self.log_info(f"Source '{source}' already assigned to publication '{publication}' with search term '{search_term}'")
+					write(info(f"Source '{source}' already assigned to publication '{publication}' with search term '{search_term}'"))
+			self.log_success(f"Assigned source '{source}' with search term '{search_term}' to {len(publications) - num_known} publication(s), {num_known} already assigned")
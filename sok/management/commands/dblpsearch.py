@@ -1,7 +1,3 @@
-import pickle
-
-from collections import defaultdict
-from pathlib import Path
 from typing import Any, Dict, List, Optional, Set
 
 from django.core.management.base import BaseCommand, CommandError, CommandParser
@@ -9,6 +5,7 @@ from django.db import transaction
 
 import sok.management.commands.dblpimport as dblp
 
+from sok.management.commands._choices import Choices
 from sok.management.commands.snowball import semanticscholar
 from sok.models import (
 	Author,
@@ -64,14 +61,22 @@ class Command(BaseCommand):
 	) -> Publication:
 
 		# Store Authors
-		authors: List[Author] = []
-		for name in result.authors:
-			author, created = Author.objects.get_or_create(name=name)
-			if created:
+		names: Set[str] = set(result.authors)
+		authors_by_name: Dict[str, Author] = Author.objects.in_bulk(names, field_name='name')
+		new_names: Set[str] = names - authors_by_name.keys()
+		if 0 < len(new_names):
+			Author.objects.bulk_create(
+				[Author(name=name) for name in new_names],
+				ignore_conflicts=True,
+			)
+			authors_by_name.update(Author.objects.in_bulk(new_names, field_name='name'))
+		for name in dict.fromkeys(result.authors):  # In author order
+			author = authors_by_name[name]
+			if name in new_names:
 				self.log_success(f"Added author: {author}")
 			else:
 				self.log_info(f"Author '{author}' alreay known")
-			authors.append(author)
+		authors: List[Author] = [authors_by_name[name] for name in result.authors]
 
 		# Store Publication
 		publication = Publication(
@@ -82,21 +87,17 @@ class Command(BaseCommand):
 			first_page=result.first_page,
 			last_page=result.last_page,
 		)
-		publication.full_clean()
+		publication.clean_fields()
 		publication.save()
 		self.log_success(f"Added publication: {publication}")
 
-		# Assign authors to publication
+		# Assign authors to publication, which is new and has none yet
+		PublicationAuthor.objects.bulk_create([
+			PublicationAuthor(author=author, publication=publication, position=position)
+			for position, author in enumerate(authors)
+		])
 		for position, author in enumerate(authors):
-			publication_author, created = PublicationAuthor.objects.get_or_create(
-				author=author,
-				publication=publication,
-				position=position,
-			)
-			if created:
-				self.log_success(f"Assigned author '{author}' to publication '{publication}' at position {position}")
-			else:
-				self.log_info(f"Author '{author}' already assigned to publication '{publication}' at position '{position}'")
+			self.log_success(f"Assigned author '{author}' to publication '{publication}' at position {position}")
 
 		if paper_id is not None:
 			s, created = SemanticScholar.objects.get_or_create(paper_id=paper_id, publication=publication)
@@ -123,16 +124,6 @@ class Command(BaseCommand):
 			reset_choices: bool = options['reset_choices']
 			source = Source.objects.get(name='DBLP')
 
-			path = Path('.choices.dblp.pickle')
-			cache: Dict[str, Set[str]] = defaultdict(set)
-			if reset_choices:
-				path.unlink(missing_ok=True)
-			elif path.exists():
-				self.log_info("Loading previous choices (reset with --reset-choices)...", nl=False)
-				with path.open('rb') as f:
-					cache = pickle.load(f)
-				self.log_success("done")
-
 			self.log_info("Querying DBLP... ", nl=False)
 			query, results, total = dblp.PublicationResult.from_search(options['term'], limit)
 			self.log_success(f"done, found {len(results)}/{total} publication(s)")
@@ -144,38 +135,59 @@ class Command(BaseCommand):
 
 			# Add search term to existing entries
 			cite_keys = {result.cite_key for result in results}
-			existing: Set[str] = set()
-			for publication in Publication.objects.filter(cite_key__in=cite_keys):
-				existing.add(publication.cite_key)
-				self.add_publication_source(publication, source, search_term)
-
-			# Promt the user for importing new entries
-			for result in results:
-				# Skip existing entries
-				if result.cite_key in existing.union(cache[query]):
-					continue
-
-				self.display_result(result)
-
-				# TODO Add abstract from semantic scholar
-
-				data: Dict[str, Any] = dict()
-				if doi := result.doi:
-					data = semanticscholar(doi)
-
-				while True:
-					choice = input("Import? [y/N], Show abstract? [a]: ").lower()
-					if choice in {'y', 'yes'}:
-						self.store_result(result, source, search_term, data.get('paperId', None))
-						break
-					elif choice in {'', 'n', 'no'}:
-						# Store choice
-						cache[query].add(result.cite_key)
-						with path.open('wb') as f:
-							pickle.dump(cache, f)
-						break
-					elif choice == 'a':
-						if abstract := data.get('abstract', None):
-							self.stdout.write(abstract)
+			existing: Dict[str, Publication] = Publication.objects.in_bulk(cite_keys, field_name='cite_key')
+			assigned: Set[int] = set(
+				PublicationSource.objects.filter(
+					source=source,
+					search_term=search_term,
+					publication__in=existing.values(),
+				).values_list('publication_id', flat=True)
+			)
+			PublicationSource.objects.bulk_create(
+				[
+					PublicationSource(source=source, publication=publication, search_term=search_term)
+					for publication in existing.values()
+					if publication.pk not in assigned
+				],
+				ignore_conflicts=True,
+			)
+			for publication in existing.values():
+				if publication.pk in assigned:
+					self.log_info(f"Source '{source}' already assigned to publication '{publication}' with search term '{search_term}'")
+				else:
+					self.log_success(f"Assigned source '{source}' to publication '{publication}' with search term '{search_term}'")
+
+			with Choices('dblp') as choices:
+				if reset_choices:
+					choices.reset()
+
+				# Skip existing entries and previous choices
+				skip: Set[str] = existing.keys() | choices.load(query)
+
+				# Promt the user for importing new entries
+				for result in results:
+					if result.cite_key in skip:
+						continue
+
+					self.display_result(result)
+
+					# TODO Add abstract from semantic scholar
+
+					data: Dict[str, Any] = dict()
+					if doi := result.doi:
+						data = semanticscholar(doi)
+
+					while True:
+						choice = input("Import? [y/N], Show abstract? [a]: ").lower()
+						if choice in {'y', 'yes'}:
+							self.store_result(result, source, search_term, data.get('paperId', None))
+							break
+						elif choice in {'', 'n', 'no'}:
+							# Store choice
+							choices.add(result.cite_key, query)
+							break
+						elif choice == 'a':
+							if abstract := data.get('abstract', None):
+								self.stdout.write(abstract)
 		except KeyboardInterrupt:
 			raise CommandError("Aborted.")
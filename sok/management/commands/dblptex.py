@@ -1,9 +1,9 @@
-import requests
-
 from django.core.management.base import BaseCommand, CommandError, CommandParser
 
 import sok.management.commands.dblpimport as dblp
 
+from sok.management.commands._http import session
+
 
 class Command(BaseCommand):
 
@@ -15,8 +15,8 @@ class Command(BaseCommand):
 	def handle(self, *args, **options):
 		key = dblp.strip_cite_key_prefix(options['key'])
 		url = f'https://dblp.uni-trier.de/rec/{key}.bib?param=0'
-		response = requests.get(url)
-		response.raise_for_status
+		response = session.get(url)
+		response.raise_for_status()
 
 		# The status does not necessarily indicate success, but returns an error
 		# page instead.
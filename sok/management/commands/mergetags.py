@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, List, Optional
 
 from django.core.management.base import BaseCommand, CommandError, CommandParser
 from django.db import transaction
@@ -38,33 +38,47 @@ class Command(BaseCommand):
 			return None
 
 	@transaction.atomic
-	def merge(self, lhs: Tag, rhs: Tag, publication: Publication):
+	def merge(self, lhs: Tag, rhs: Tag):
 		assert lhs.pk != rhs.pk
 
-		rhs_rel = PublicationTag.objects.get(publication=publication, tag=rhs)
-		lhs_rel, created = PublicationTag.objects.get_or_create(
-			publication=publication,
-			tag=lhs,
-		)
-
-		changed = False
-		if lhs_cmt := lhs_rel.comment:
-			if rhs_cmt := rhs_rel.comment:
-				if lhs_cmt != rhs_cmt:
-					lhs_rel.cmt = f"{lhs_cmt}; {rhs_cmt}"
-					changed = True
-		else:
-			lhs_rel.comment = rhs_rel.comment
-			changed = True
-
-		rhs.publications.remove(publication)
-
-		if changed:
-			lhs_rel.full_clean()
-			lhs_rel.save()
-			self.success(f"{lhs} <- {rhs} [{publication.cite_key}]: {lhs_rel.comment}")
-		else:
-			self.success(f"{lhs} <- {rhs} [{publication.cite_key}]")
+		rhs_rels = PublicationTag.objects.filter(tag=rhs)
+		lhs_rels = PublicationTag.objects.filter(tag=lhs)
+		rels: List[PublicationTag] = list(rhs_rels.select_related('publication'))
+		existing: Dict[int, PublicationTag] = {
+			rel.publication_id: rel
+			for rel in lhs_rels.filter(publication__in=rhs_rels.values('publication'))
+		}
+
+		# Move publications that are not yet tagged with `lhs`
+		rhs_rels.exclude(publication__in=lhs_rels.values('publication')).update(tag=lhs)
+
+		# Merge comments of publications tagged with both
+		changed: List[PublicationTag] = []
+		for rhs_rel in rels:
+			publication = rhs_rel.publication
+			if (lhs_rel := existing.get(publication.pk, None)) is None:
+				self.success(f"{lhs} <- {rhs} [{publication.cite_key}]: {rhs_rel.comment}")
+				continue
+
+			merged = False
+			if lhs_cmt := lhs_rel.comment:
+				if rhs_cmt := rhs_rel.comment:
+					if lhs_cmt != rhs_cmt:
+						lhs_rel.comment = f"{lhs_cmt}; {rhs_cmt}"
+						merged = True
+			else:
+				lhs_rel.comment = rhs_rel.comment
+				merged = True
+
+			if merged:
+				lhs_rel.full_clean()
+				changed.append(lhs_rel)
+				self.success(f"{lhs} <- {rhs} [{publication.cite_key}]: {lhs_rel.comment}")
+			else:
+				self.success(f"{lhs} <- {rhs} [{publication.cite_key}]")
+
+		PublicationTag.objects.bulk_update(changed, ['comment'])
+		rhs_rels.delete()
 
 	# BaseCommand
 
@@ -79,5 +93,4 @@ class Command(BaseCommand):
 		if lhs == rhs:
 			raise CommandError(f"Cannot merge tag with itself: {lhs}")
 
-		for publication in rhs.publications.all():
-			self.merge(lhs, rhs, publication)
+		self.merge(lhs, rhs)
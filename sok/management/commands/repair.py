@@ -1,9 +1,10 @@
-from pprint import pprint
 from time import sleep
+from typing import Dict, List, Set, Tuple
 
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef
 
 import sok.management.commands.dblpimport as dblp
 
@@ -35,23 +36,45 @@ class Command(BaseCommand):
 		"""
 
 		self.log_info("--- Searching for references to variants ---")
-		for publication in Publication.objects.filter(variant_of__isnull=False):
-			variant = publication.variant_of
-			origs = PublicationReference.objects.filter(reference=publication)
-			for orig in origs:
-				if PublicationReference.objects.filter(reference=variant, publication=orig.publication).exists():
-					continue
-				fixed = PublicationReference(
-					reference=variant,
-					publication=orig.publication,
-					identifier=('' if orig.identifier is None else orig.identifier) + "*",
-				)
-				try:
-					fixed.full_clean()
-					fixed.save()
-					self.log_success(f"Added reference: {publication} -- {fixed.identifier} -> {variant}")
-				except ValidationError as e:
-					raise CommandError(f"{publication} -- {fixed.identifier} -> {variant}: {e}")
+		has_master_reference = PublicationReference.objects.filter(
+			publication=OuterRef('publication'),
+			reference=OuterRef('reference__variant_of'),
+		)
+		origs = PublicationReference.objects.filter(
+			reference__variant_of__isnull=False,
+		).exclude(
+			Exists(has_master_reference),
+		).order_by('reference', 'pk').values_list(
+			'publication_id',
+			'reference__cite_key',
+			'reference__variant_of_id',
+			'reference__variant_of__cite_key',
+			'identifier',
+		)
+
+		fixes: Dict[Tuple[int, int], PublicationReference] = dict()
+		messages: List[str] = []
+		for publication_id, reference, variant_id, variant, identifier in origs:
+			if (publication_id, variant_id) in fixes:
+				continue  # Another variant of the same master is referenced
+			fixed = PublicationReference(
+				reference_id=variant_id,
+				publication_id=publication_id,
+				identifier=('' if identifier is None else identifier) + "*",
+			)
+			try:
+				fixed.clean_fields(exclude=['publication', 'reference'])
+			except ValidationError as e:
+				raise CommandError(f"{reference} -- {fixed.identifier} -> {variant}: {e}")
+			fixes[(publication_id, variant_id)] = fixed
+			messages.append(f"Added reference: {reference} -- {fixed.identifier} -> {variant}")
+
+		try:
+			PublicationReference.objects.bulk_create(fixes.values())
+		except IntegrityError as e:
+			raise CommandError(f"Cannot add references to masters: {e}")
+		for message in messages:
+			self.log_success(message)
 
 	def fix_dblp(self):
 		self.log_info("--- Searching for entries not in the default DBLP dump ---")
@@ -60,11 +83,18 @@ class Command(BaseCommand):
 				cite_key__startswith=dblp.CITE_KEY_PREFIX
 			).values_list('cite_key', flat=True).distinct()
 		)
-		keys_in_dump = dblp.get_all_cite_keys(dblp.DUMP_PATH)
+
+		# Stream the dump, only the keys in the database are kept in memory
+		missing: Set[str] = set(keys_in_db)
+		num_in_dump = 0
+		for key in dblp.iter_all_cite_keys(dblp.DUMP_PATH):
+			num_in_dump += 1
+			missing.discard(key)
 
 		self.stdout.write(f"DB:   {len(keys_in_db):8d}")
-		self.stdout.write(f"DBLP: {len(keys_in_dump):8d}")
-		pprint(keys_in_db - keys_in_dump)
+		self.stdout.write(f"DBLP: {num_in_dump:8d}")
+		if 0 < len(missing):
+			self.stdout.write('\n'.join(sorted(missing)))
 
 	def find_missing_dois(self):
 		self.log_info("--- Searching for missing DOIs ---")
@@ -77,13 +107,21 @@ class Command(BaseCommand):
 		results = dblp.PublicationResult.from_dump(dblp.DUMP_PATH, keys)
 		self.log_info("done")
 
+		results = [result for result in results if result.doi]
+		publications_by_key: Dict[str, Publication] = publications.in_bulk(
+			[result.cite_key for result in results],
+			field_name='cite_key',
+		)
+		fixed: List[Publication] = []
 		for result in results:
-			if doi := result.doi:
-				publication = publications.get(cite_key=result.cite_key)
-				publication.doi = doi
-				publication.full_clean()
-				publication.save()
-				self.log_success(f"Added DOI '{doi}' to publication: {publication}")
+			publication = publications_by_key[result.cite_key]
+			publication.doi = result.doi
+			publication.clean_fields()  # Uniqueness is checked by the database
+			fixed.append(publication)
+
+		Publication.objects.bulk_update(fixed, ['doi'], batch_size=500)
+		for publication in fixed:
+			self.log_success(f"Added DOI '{publication.doi}' to publication: {publication}")
 
 	def find_semanticscholar_ids(self):
 		self.log_info("--- Searching for paper IDs on Semantic Scholar ---")
@@ -96,7 +134,7 @@ class Command(BaseCommand):
 
 			paper_id = data['paperId']
 			obj = SemanticScholar(paper_id=paper_id, publication=publication)
-			obj.full_clean()
+			obj.clean_fields(exclude=['publication'])
 			obj.save()
 			self.log_success(f"Set semanticscholar ID for publication '{publication}': {paper_id}")
 
@@ -1,19 +1,25 @@
 import hashlib
 import json
-import pickle
 
-from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from time import sleep
-from typing import Any, Dict, List, Set
-
-import requests
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Set, Tuple
 
 from django.core.management.base import BaseCommand, CommandParser, CommandError
 from tqdm import tqdm
 
+from sok.management.commands._choices import Choices
+from sok.management.commands._http import session
 from sok.models import Publication, PublicationReference, SemanticScholar
 
 
+# Number of papers fetched ahead while the user is prompted
+PREFETCH = 4
+
+
+@lru_cache(maxsize=256)
 def semanticscholar(identifier: str, include_unknown_references: bool = False) -> Dict[str, Any]:
 	"""
 	Retrieve information from the Semantic Scholar API.
@@ -27,11 +33,17 @@ def semanticscholar(identifier: str, include_unknown_references: bool = False) -
 	params: Dict[str, Any] = dict()
 	if include_unknown_references:
 		params['include_unknown_references'] = 'true'
-	response = requests.get(url, params=params)
-	response.raise_for_status
+	response = session.get(url, params=params)
+	response.raise_for_status()
 	return response.json()
 
 
+def fetch_throttled(paper_id: str) -> Dict[str, Any]:
+	data = semanticscholar(paper_id)
+	sleep(2)  # Throttle to avoid rate-limiting
+	return data
+
+
 class Command(BaseCommand):
 
 	def echo(self, msg: str, bold: bool = False, nl: bool = True):
@@ -63,7 +75,6 @@ class Command(BaseCommand):
 				publication=publication,
 				reference=reference,
 			)
-			rel.full_clean()
 			rel.save()
 			if is_reference:
 				self.echo(f"Added reference: {reference}")
@@ -104,30 +115,37 @@ class Command(BaseCommand):
 		title = "Reference" if is_reference else "Citation"
 		if 0 < len(objs):
 			self.echo(f"--- {title}s ---")
+
+		# Look up known papers for all objects at once
+		paper_ids: Set[str] = {obj['paperId'] for obj in objs if obj.get('paperId', None)}
+		known: Dict[str, SemanticScholar] = SemanticScholar.objects.select_related(
+			'publication',
+		).in_bulk(paper_ids, field_name='paper_id')
+		dois: Set[str] = {
+			obj['doi'] for obj in objs
+			if obj.get('doi', None) and obj.get('paperId', None) not in known
+		}
+		publications_by_doi: Dict[str, Publication] = Publication.objects.in_bulk(dois, field_name='doi')
+
 		for obj in tqdm(objs, unit=title.lower()):
 			if paper_id := obj.get('paperId', None):
-				try:
-					existing = SemanticScholar.objects.get(paper_id=paper_id)
+				if existing := known.get(paper_id, None):
 					if is_reference:
 						self.add_reference(base, existing.publication)
 					else:
 						self.add_reference(existing.publication, base, is_reference)
 					continue
-				except SemanticScholar.DoesNotExist:
-					if doi := obj.get('doi', None):
-						try:
-							publication = Publication.objects.get(doi=doi)
-							new = SemanticScholar(paper_id=paper_id, publication=publication)
-							new.full_clean()
-							new.save()
-							self.echo(f"New Semantic Scholar entry: {paper_id}")
-							if is_reference:
-								self.add_reference(base, new.publication)
-							else:
-								self.add_reference(new.publication, base, is_reference)
-							continue
-						except Publication.DoesNotExist:
-							pass
+				if publication := publications_by_doi.get(obj.get('doi', None), None):
+					new = SemanticScholar(paper_id=paper_id, publication=publication)
+					new.clean_fields(exclude=['publication'])
+					new.save()
+					known[paper_id] = new
+					self.echo(f"New Semantic Scholar entry: {paper_id}")
+					if is_reference:
+						self.add_reference(base, new.publication)
+					else:
+						self.add_reference(new.publication, base, is_reference)
+					continue
 
 			identifier = self.get_identifier(obj)
 			if identifier in self.cache:
@@ -145,8 +163,7 @@ class Command(BaseCommand):
 				if choice in {'', 'y', 'yes'}:
 					# Store choice
 					self.cache.add(identifier)
-					with self.cache_path.open('wb') as f:
-						pickle.dump(self.cache, f)
+					self.choices.add(identifier)
 					break
 				elif choice in {'a'}:
 					assert paper_id is not None
@@ -157,6 +174,24 @@ class Command(BaseCommand):
 					# TODO Import?
 					break
 
+	def fetch_ahead(
+		self,
+		executor: ThreadPoolExecutor,
+		papers: Iterable[Tuple[Publication, str]],
+	) -> Iterator[Tuple[Publication, Dict[str, Any]]]:
+		"""
+		Fetch the next papers in the background, while the user is prompted.
+		"""
+
+		pending: Deque[Tuple[Publication, Future]] = deque()
+		for publication, paper_id in papers:
+			pending.append((publication, executor.submit(fetch_throttled, paper_id)))
+			if PREFETCH < len(pending):
+				current, future = pending.popleft()
+				yield current, future.result()
+		for current, future in pending:
+			yield current, future.result()
+
 	# BaseCommand
 
 	def add_arguments(self, parser: CommandParser):
@@ -169,25 +204,35 @@ class Command(BaseCommand):
 		no_citations: bool = options['no_citations']
 		no_references: bool = options['no_references']
 
-		self.cache_path = Path('.choices.semanticscholar.pickle')
-		self.cache: Set[str] = set()
-		if reset_choices:
-			self.cache_path.unlink(missing_ok=True)
-		elif self.cache_path.exists():
-			self.echo("Loading previous choices (reset with --reset-choices)...", nl=False)
-			with self.cache_path.open('rb') as f:
-				self.cache = pickle.load(f)
-			self.echo("done", bold=True)
-
-		publications = Publication.objects.filter(
-			semanticscholar__isnull=False,
-			exclusion_criteria__isnull=True,
+		# Stream the papers of relevant publications along with the publication
+		semantics = SemanticScholar.objects.filter(
+			publication__exclusion_criteria__isnull=True,
+		).select_related('publication').order_by('publication', 'pk')
+		num_papers = semantics.count()
+		papers: Iterator[Tuple[Publication, str]] = (
+			(semantic.publication, semantic.paper_id)
+			for semantic in semantics.iterator(chunk_size=200)
 		)
-		try:
-			for publication in tqdm(publications, unit="publication"):
-				self.echo(f"=== Publication {publication} ===")
-				for semantic in publication.semanticscholar_set.all():
-					data = semanticscholar(semantic.paper_id)
+
+		# A single worker keeps the requests sequential and throttled
+		executor = ThreadPoolExecutor(max_workers=1)
+		with Choices('semanticscholar') as choices:
+			self.choices = choices
+			self.cache: Set[str] = set()
+			if reset_choices:
+				choices.reset()
+			else:
+				self.echo("Loading previous choices (reset with --reset-choices)...", nl=False)
+				self.cache = choices.load()
+				self.echo("done", bold=True)
+
+			try:
+				previous = None
+				fetched = self.fetch_ahead(executor, papers)
+				for publication, data in tqdm(fetched, total=num_papers, unit="paper"):
+					if publication != previous:
+						self.echo(f"=== Publication {publication} ===")
+						previous = publication
 
 					if not no_references:
 						references: List[Dict[str, Any]] = data['references']
@@ -196,7 +241,7 @@ class Command(BaseCommand):
 					if not no_citations:
 						citations: List[Dict[str, Any]] = data['citations']
 						self.handle_objs(publication, citations, is_reference=False)
-
-					sleep(2)  # Throttle
-		except KeyboardInterrupt:
-			raise CommandError("Aborted.")
+			except KeyboardInterrupt:
+				raise CommandError("Aborted.")
+			finally:
+				executor.shutdown(wait=False, cancel_futures=True)
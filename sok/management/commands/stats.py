@@ -1,7 +1,7 @@
-from typing import Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set
 
 from django.core.management.base import BaseCommand
-from django.db.models import Count, Q
 
 import sok.management.commands.dblpimport as dblp
 
@@ -15,33 +15,43 @@ class Command(BaseCommand):
 			msg = self.style.HTTP_INFO(msg)
 		self.stdout.write(msg)
 
+	def search(self, search_term: SearchTerm) -> List[dblp.PublicationResult]:
+		query, results, total = dblp.PublicationResult.from_search(search_term.name, 1000)
+		return results
+
 	# BaseCommand
 
 	def handle(self, *args, **options):
-		publications_found: Set[str] = set()
-		publications_peer_reviewed: Set[str] = set()
-		publications_relevant: Set[str] = set()
+		# DBLP search results
+		search_terms: List[SearchTerm] = list(SearchTerm.objects.all())
+		for search_term in search_terms:
+			self.echo(f"Searching DBLP for '{search_term}'")
+		peer_reviewed: Dict[str, bool] = dict()
+		with ThreadPoolExecutor(max_workers=dblp.MAX_API_REQUESTS) as executor:
+			for results in executor.map(self.search, search_terms):
+				for result in results:
+					peer_reviewed[result.cite_key] = result.is_peer_reviewed
 
+		# Only count results that are in the DBLP dump
 		self.echo("Loading DBLP dump...")
-		all_cite_keys = dblp.get_all_cite_keys(dblp.DUMP_PATH)
-
-		for search_term in SearchTerm.objects.all():
-			# DBLP search result
-			self.echo(f"Searching DBLP for '{search_term}'")
-			query, results, total = dblp.PublicationResult.from_search(search_term.name, 1000)
-			for result in results:
-				if result.cite_key not in all_cite_keys:
-					continue
-				publications_found.add(result.cite_key)
-				if result.is_peer_reviewed:
-					publications_peer_reviewed.add(result.cite_key)
-
-			# Relevant publications
-			for publication in Publication.objects.filter(
-				publicationsource__search_term=search_term,
+		publications_found: Set[str] = {
+			cite_key
+			for cite_key in dblp.iter_all_cite_keys(dblp.DUMP_PATH)
+			if cite_key in peer_reviewed
+		}
+		publications_peer_reviewed: Set[str] = {
+			cite_key
+			for cite_key in publications_found
+			if peer_reviewed[cite_key]
+		}
+
+		# Relevant publications
+		publications_relevant: Set[str] = set(
+			Publication.objects.filter(
+				publicationsource__search_term__in=search_terms,
 				exclusion_criteria__isnull=True,
-			).distinct():
-				publications_relevant.add(publication.cite_key)
+			).values_list('cite_key', flat=True)
+		)
 
 		# Output
 		self.echo(f"Total publications: {len(publications_found):4d}", bold=True)
@@ -1,7 +1,8 @@
 import html
+import io
 
-from functools import lru_cache
-from typing import Optional, Set, Tuple
+from collections import defaultdict, deque
+from typing import Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
 
 from django.core.management.base import BaseCommand, CommandParser
 
@@ -10,114 +11,174 @@ from sok.models import Publication, PublicationTag, Tag
 
 class Command(BaseCommand):
 
-	def echo(self, msg: str, nl: bool = True):
-		self.stdout.write(msg, ending='\n' if nl else '')
+	# Output templates, each node and edge is written at once
+	NODE = '\tT{pk} [\n\t\tlabel="{label}",\n{style}\t];\n'
+	NODE_EMPTY = '\t\tcolor=firebrick2,\n\t\tfontcolor=firebrick3,\n'
+	NODE_IMPLICIT = '\t\tcolor=gainsboro,\n\t\tfontcolor=gray,\n'
+	EDGE = '\tT{source} -> T{target}{style};\n'
+	EDGE_EMPTY = ' [color=firebrick2]'
 
-	@lru_cache
-	def transitive_publications(self, tag: Tag):
-		return tag.transitive_publications
+	def echo(self, msg: str, nl: bool = True):
+		# Output is buffered and written at once, see graphviz()
+		self.buffer.write(msg)
+		if nl:
+			self.buffer.write('\n')
+
+	def transitive_publications(self, pk: int) -> FrozenSet[int]:
+		return self.publications.get(pk, frozenset())
+
+	def num_publications(self, pk: int) -> int:
+		return len(self.transitive_publications(pk))
+
+	def cyclic_tags(self) -> List[int]:
+		"""
+		Tags on implication cycles.
+
+		Uses Kahn's algorithm in both directions, so that only tags on or
+		between cycles remain, not the ones merely implying or implied by them.
+		"""
+
+		implies: Dict[int, List[int]] = defaultdict(list)
+		for to_pk, from_pks in self.implied_by.items():
+			for from_pk in from_pks:
+				implies[from_pk].append(to_pk)
+
+		remaining: Set[int] = set(self.names)
+		for incoming, outgoing in ((self.implied_by, implies), (implies, self.implied_by)):
+			degree: Dict[int, int] = {
+				pk: sum(1 for other in incoming[pk] if other in remaining)
+				for pk in remaining
+			}
+			queue = deque(pk for pk, num in degree.items() if 0 == num)
+			while 0 < len(queue):
+				pk = queue.popleft()
+				remaining.discard(pk)
+				for other in outgoing[pk]:
+					if other not in remaining:
+						continue
+					degree[other] -= 1
+					if 0 == degree[other]:
+						queue.append(other)
+
+		return sorted(remaining)
+
+	def add_node(self, node: int, max_depth: int = 0):
+		# Depth-first in the same order as a recursive traversal
+		stack: List[Tuple[int, int]] = [(node, 0)]
+		while 0 < len(stack):
+			node, depth = stack.pop()
+			if node in self.nodes:
+				continue  # Already added this node
+			if node not in self.node_lines:
+				continue  # Filtered out, see graphviz()
+			if 0 < max_depth and max_depth < depth:
+				continue
 
-	@lru_cache
-	def num_publications(self, tag: Tag):
-		return len(self.transitive_publications(tag))
+			self.nodes[node] = self.node_lines[node]
+			if 0 < max_depth and max_depth == depth:
+				continue  # Predecessors would be too deep
+			stack.extend(
+				(predecessor, depth + 1)
+				for predecessor in reversed(self.implied_by[node])
+				if predecessor in self.node_lines and predecessor not in self.nodes
+			)
 
-	def add_node(
+	def node_line(
 		self,
-		node: Tag,
+		node: int,
 		publication: Optional[Publication] = None,
-		threshold: int = 0,
 		include_publications: bool = False,
-		max_depth: int = 0,
-		depth: int = 0,
-	):
-		if 0 < max_depth and max_depth < depth:
-			return
-
+	) -> str:
 		publications = self.transitive_publications(node)
 		num = self.num_publications(node)
 
-		if node.pk in self.nodes:
-			return  # Already printed this node
-		if num < threshold:
-			return
-		if not (publication is None or publication in publications):
-			return
-
-		name = html.escape(node.name)
-		self.echo(f"\tT{node.pk} [")
-		self.echo(f'\t\tlabel="{name}', nl=False)
+		label = self.escaped_names[node]
 		implicit: bool = False
 		if publication is None:
 			if include_publications:
-				pubs = ','.join([str(t.pk) for t in publications])
-				self.echo(f"|{{{num}|{pubs}}}", nl=False)
+				pubs = ','.join([str(pk) for pk in sorted(publications)])
+				label += f"|{{{num}|{pubs}}}"
 			else:
-				self.echo(f"|{num}", nl=False)
+				label += f"|{num}"
 		else:
-			try:
-				rel = PublicationTag.objects.get(publication=publication, tag=node)
-				if comment := rel.comment:
-					comment = html.escape(rel.comment)
-					self.echo(f"|{comment}", nl=False)
-			except PublicationTag.DoesNotExist:
-				implicit = True
-		self.echo('",')
-		if 0 == num:
-			self.echo("\t\tcolor=firebrick2,")
-			self.echo("\t\tfontcolor=firebrick3,")
-		if implicit:
-			self.echo("\t\tcolor=gainsboro,")
-			self.echo("\t\tfontcolor=gray,")
-		self.echo("\t];")
-
-		self.nodes.add(node.pk)
-		for predecessor in node.implied_by.all():
-			self.add_node(predecessor, publication, threshold, include_publications, max_depth, depth + 1)
-
-	def add_edge(self, node: Tag):
-		for predecessor in node.implied_by.all():
-			if predecessor.pk not in self.nodes:
+			# Tags not assigned to the publication are implied by assigned ones
+			implicit = node not in self.escaped_comments
+			if comment := self.escaped_comments.get(node):
+				label += f"|{comment}"
+
+		return self.NODE.format_map({
+			'pk': node,
+			'label': label,
+			'style': (
+				(self.NODE_EMPTY if 0 == num else '')
+				+ (self.NODE_IMPLICIT if implicit else '')
+			),
+		})
+
+	def add_edge(self, node: int):
+		# Depth-first, each predecessor is descended into right after its edge
+		stack: List[Tuple[int, Iterator[int]]] = [(node, iter(self.implied_by[node]))]
+		while 0 < len(stack):
+			node, predecessors = stack[-1]
+			predecessor = next(predecessors, None)
+			if predecessor is None:
+				stack.pop()
 				continue
-			edge = (predecessor.pk, node.pk)
-			if edge in self.graph:
+			if predecessor not in self.nodes:
 				continue
-			if edge[::-1] in self.graph:
-				self.stderr.write(self.style.ERROR(f"CYCLE: '{node}' <-> '{predecessor}'"))
+			edge = (predecessor, node)
+			if edge in self.graph:
+				continue  # Also terminates on cycles
 			self.graph.add(edge)
-			self.echo(f"\tT{predecessor.pk} -> T{node.pk}", nl=False)
-			if 0 == self.num_publications(predecessor):
-				self.echo(" [color=firebrick2]", nl=False)
-			self.echo(";")
-			self.add_edge(predecessor)
+			self.buffer.write(self.EDGE.format_map({
+				'source': predecessor,
+				'target': node,
+				'style': self.EDGE_EMPTY if 0 == self.num_publications(predecessor) else '',
+			}))
+			stack.append((predecessor, iter(self.implied_by[predecessor])))
 
 	def graphviz(
 		self,
-		root: Optional[Tag] = None,
+		root: Optional[int] = None,
 		publication: Optional[Publication] = None,
 		threshold: int = 0,
 		include_publications: bool = False,
 		max_depth: int = 0,
 	):
+		self.buffer = io.StringIO()
 		self.echo("digraph G {")
 		self.echo("\trankdir = RL;")
 		self.echo("\tnode [shape=record];")
 
+		# Render all tags passing the filters once, the traversal only
+		# selects which of them are emitted
+		self.node_lines: Dict[int, str] = {
+			pk: self.node_line(pk, publication, include_publications)
+			for pk in self.names
+			if threshold <= self.num_publications(pk) and (
+				publication is None or publication.pk in self.transitive_publications(pk)
+			)
+		}
+
+		# Start at the given tag or at all tags not implying others
+		roots: List[int] = [root] if root is not None else [
+			pk for pk in self.names
+			if pk not in self.implying
+		]
+
 		# Add nodes
-		if root is None:
-			for tag in Tag.objects.filter(implies__isnull=True):
-				self.add_node(tag, publication, threshold, include_publications, max_depth)
-		else:
-			self.add_node(root, publication, threshold, include_publications, max_depth)
+		for pk in roots:
+			self.add_node(pk, max_depth)
+		self.buffer.write(''.join(self.nodes.values()))
 
 		# Add edges
-		if root is None:
-			for tag in Tag.objects.filter(implies__isnull=True):
-				self.add_edge(tag)
-		else:
-			self.add_edge(root)
+		for pk in roots:
+			self.add_edge(pk)
 
 		self.echo("}")
 
+		self.stdout.write(self.buffer.getvalue(), ending='')
+
 	# BaseCommand
 
 	def add_arguments(self, parser: CommandParser):
@@ -132,14 +193,43 @@ class Command(BaseCommand):
 		threshold: int = options['threshold']
 		max_depth: int = options['depth']
 
-		root: Optional[Tag] = None
+		root: Optional[int] = None
 		if tag_name := options.get('root', None):
-			root = Tag.objects.get(name=tag_name)
+			root = Tag.objects.values_list('pk', flat=True).get(name=tag_name)
 
 		publication: Optional[Publication] = None
 		if cite_key := options.get('publication', None):
-			publication = Publication.objects.get(cite_key=cite_key)
+			publication = Publication.objects.only('pk', 'cite_key').get(cite_key=cite_key)
+
+		# Load the whole tag DAG at once, tags are referred to by primary key
+		self.names: Dict[int, str] = dict(Tag.objects.order_by('pk').values_list('pk', 'name'))
+		self.escaped_names: Dict[int, str] = {
+			pk: html.escape(name)
+			for pk, name in self.names.items()
+		}
+		self.implied_by: Dict[int, List[int]] = defaultdict(list)
+		self.implying: Set[int] = set()
+		edges = Tag.implies.through.objects.values_list('from_tag_id', 'to_tag_id').order_by('pk')
+		for from_pk, to_pk in edges:
+			self.implied_by[to_pk].append(from_pk)
+			self.implying.add(from_pk)
+
+		# Comments of the tags explicitly assigned to the publication
+		self.escaped_comments: Dict[int, str] = dict()
+		if publication is not None:
+			self.escaped_comments = {
+				tag_pk: html.escape(comment or '')
+				for tag_pk, comment in PublicationTag.objects.filter(
+					publication=publication,
+				).values_list('tag_id', 'comment')
+			}
+
+		if cycle := self.cyclic_tags():
+			names = ', '.join(f"'{self.names[pk]}'" for pk in cycle)
+			self.stderr.write(self.style.ERROR(f"CYCLE: {names}"))
+
+		self.publications: Dict[int, FrozenSet[int]] = Tag.bulk_transitive_publications()
 
 		self.graph: Set[Tuple[int, int]] = set()
-		self.nodes: Set[int] = set()
+		self.nodes: Dict[int, str] = dict()
 		self.graphviz(root, publication, threshold, include_publications, max_depth)
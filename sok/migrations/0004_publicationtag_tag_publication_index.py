@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sok', '0003_remove_publication_references_complete'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='publicationtag',
+            index=models.Index(fields=['tag', 'publication'], name='sok_publica_tag_id_6d3dab_idx'),
+        ),
+    ]
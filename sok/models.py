@@ -1,7 +1,11 @@
-from typing import Optional, Set
+from functools import cached_property
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set
 
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import connection, models
+from django.db.models import Case, CharField, Exists, OuterRef, Value, When
 from django.db.models.query import QuerySet
 
 
@@ -17,16 +21,64 @@ class Tag(models.Model):
 	criteria = models.TextField(blank=True)
 	implies = models.ManyToManyField('Tag', related_name='implied_by', blank=True)
 
-	@property
+	@cached_property
+	def transitive_publication_ids(self) -> FrozenSet[int]:
+		return Tag.bulk_transitive_publications([self.pk]).get(self.pk, frozenset())
+
+	@cached_property
 	def transitive_publications(self) -> Set['Publication']:
-		publications: Set[Publication] = set(self.publications.filter(exclusion_criteria__isnull=True))
-		for implied in self.implied_by.all():
-			publications = publications.union(implied.transitive_publications)
-		return publications
+		return set(Publication.objects.filter(pk__in=self.transitive_publication_ids))
 
 	@property
 	def total_publications(self) -> int:
-		return len(self.transitive_publications)
+		return len(self.transitive_publication_ids)
+
+	@classmethod
+	def bulk_transitive_publications(cls, tag_ids: Optional[Iterable[int]] = None) -> Dict[int, FrozenSet[int]]:
+		"""
+		Map tags to their relevant publications and those of tags implying them.
+
+		Uses a single recursive query instead of walking the tags, and only
+		contains the primary keys of tags and publications. Tags without
+		relevant publications are omitted.
+		"""
+
+		params: List[int] = []
+		roots = f"SELECT id, id FROM {cls._meta.db_table}"
+		if tag_ids is not None:
+			params = list(tag_ids)
+			if 0 == len(params):
+				return dict()
+			placeholders = ', '.join(['%s'] * len(params))
+			roots += f" WHERE id IN ({placeholders})"
+
+		implies = cls.implies.through._meta.db_table
+		publication_tags = PublicationTag._meta.db_table
+		exclusion_criteria = Publication.exclusion_criteria.through._meta.db_table
+		query = f"""
+			WITH RECURSIVE closure(root, tag) AS (
+				{roots}
+				UNION
+				SELECT closure.root, implies.from_tag_id
+				FROM closure
+				JOIN {implies} implies ON implies.to_tag_id = closure.tag
+			)
+			SELECT DISTINCT closure.root, pt.publication_id
+			FROM closure
+			JOIN {publication_tags} pt ON pt.tag_id = closure.tag
+			WHERE NOT EXISTS (
+				SELECT 1 FROM {exclusion_criteria} ec WHERE ec.publication_id = pt.publication_id
+			)
+			ORDER BY closure.root
+		"""
+
+		# Rows are grouped by tag, so each set is built once from its rows
+		with connection.cursor() as cursor:
+			cursor.execute(query, params)
+			return {
+				tag_id: frozenset(map(itemgetter(1), rows))
+				for tag_id, rows in groupby(cursor.fetchall(), key=itemgetter(0))
+			}
 
 	def __str__(self) -> str:
 		return self.name
@@ -57,6 +109,43 @@ class SearchTerm(models.Model):
 		return self.name
 
 
+class PublicationQuerySet(models.QuerySet):
+
+	def with_stage(self) -> 'PublicationQuerySet':
+		"""
+		Annotate the stage of each publication as `stage_value`.
+
+		This is equivalent to `Publication.stage`, but evaluated by the database
+		for all publications at once, so it can also be used for filtering and
+		ordering.
+		"""
+
+		primary = Publication.objects.filter(
+			exclusion_criteria__isnull=True,
+			sources__isnull=False,
+		)
+		return self.annotate(stage_value=Case(
+			When(
+				Exists(Publication.exclusion_criteria.through.objects.filter(publication=OuterRef('pk'))),
+				then=Value('excluded'),
+			),
+			When(
+				Exists(PublicationSource.objects.filter(publication=OuterRef('pk'))),
+				then=Value('primary'),
+			),
+			When(
+				Exists(PublicationReference.objects.filter(reference=OuterRef('pk'), publication__in=primary)),
+				then=Value('secondary'),
+			),
+			When(
+				Exists(PublicationReference.objects.filter(publication=OuterRef('pk'), reference__in=primary)),
+				then=Value('tertiary'),
+			),
+			default=None,
+			output_field=CharField(null=True),
+		))
+
+
 class Publication(models.Model):
 	cite_key = models.CharField(max_length=255, unique=True)
 	title = models.CharField(max_length=255)
@@ -81,16 +170,37 @@ class Publication(models.Model):
 	exclusion_criteria = models.ManyToManyField(ExclusionCriterion, related_name='publications', blank=True)
 	tags = models.ManyToManyField(Tag, related_name='publications', through='PublicationTag')
 
-	@property
+	objects = PublicationQuerySet.as_manager()
+
+	@cached_property
 	def is_peer_reviewed_or_cited_by_peer_reviewed(self) -> bool:
 		if self.peer_reviewed:
 			return True
-		for referenced_by in self.referenced_by.filter():
-			if referenced_by.is_peer_reviewed_or_cited_by_peer_reviewed:
-				return True
-		return False
 
-	@property
+		# Walk the citing publications once, also terminates on cycles
+		publications = Publication._meta.db_table
+		references = PublicationReference._meta.db_table
+		query = f"""
+			WITH RECURSIVE citing(id) AS (
+				SELECT %s
+				UNION
+				SELECT pr.publication_id
+				FROM citing
+				JOIN {references} pr ON pr.reference_id = citing.id
+			)
+			SELECT EXISTS (
+				SELECT 1
+				FROM citing
+				JOIN {publications} p ON p.id = citing.id
+				WHERE p.peer_reviewed = %s
+			)
+		"""
+		with connection.cursor() as cursor:
+			cursor.execute(query, [self.pk, True])
+			exists, = cursor.fetchone()
+		return bool(exists)
+
+	@cached_property
 	def is_relevant(self) -> bool:
 		return not self.exclusion_criteria.exists()
 
@@ -104,6 +214,13 @@ class Publication(models.Model):
 
 	@property
 	def stage(self) -> Optional[str]:
+		"""
+		Uses the value annotated by `PublicationQuerySet.with_stage`, if available.
+		"""
+
+		if hasattr(self, 'stage_value'):
+			return self.stage_value
+
 		if not self.is_relevant:
 			return 'excluded'
 
@@ -113,12 +230,12 @@ class Publication(models.Model):
 
 		# Referenced by primary (backward snowballing)
 		# TODO make transitive
-		if self.referenced_by.filter(exclusion_criteria__isnull=True, sources__isnull=False):
+		if self.referenced_by.filter(exclusion_criteria__isnull=True, sources__isnull=False).exists():
 			return 'secondary'
 
 		# References a primary (forward snowballing)
 		# TODO make transitive
-		if self.references.filter(exclusion_criteria__isnull=True, sources__isnull=False):
+		if self.references.filter(exclusion_criteria__isnull=True, sources__isnull=False).exists():
 			return 'tertiary'
 
 		return None
@@ -163,6 +280,10 @@ class PublicationTag(models.Model):
 
 	class Meta:
 		unique_together = (('publication', 'tag'),)
+		indexes = [
+			# Look up publications by tag, the unique index leads with publication
+			models.Index(fields=['tag', 'publication']),
+		]
 
 
 class PublicationSource(models.Model):
@@ -181,8 +302,8 @@ class PublicationReference(models.Model):
 
 	@property
 	def is_self_cite(self) -> bool:
-		lhs: Set[int] = set(self.publication.authors.values_list('pk', flat=True))
-		rhs: Set[int] = set(self.reference.authors.values_list('pk', flat=True))
+		lhs: Set[int] = {author.pk for author in self.publication.authors.all()}
+		rhs: Set[int] = {author.pk for author in self.reference.authors.all()}
 		return not lhs.isdisjoint(rhs)
 
 	class Meta: